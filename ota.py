@@ -1,7 +1,6 @@
 import asyncio
 import logging
 import os
-from collections import OrderedDict
 
 from zigpy.exceptions import DeliveryError
 from zigpy.util import retryable
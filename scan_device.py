@@ -1,99 +1,289 @@
 import asyncio
+import json
 import logging
 import os
+import tempfile
 
 from zigpy.exceptions import DeliveryError
 from zigpy.util import retryable
+from zigpy.zcl import foundation
 
-from homeassistant.util.json import save_json
+from homeassistant.helpers.json import JSONEncoder
+
+from . import DATA_ZHAC
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 LOGGER = logging.getLogger(__name__)
 
+MIN_READ_CHUNK = 4
+MAX_READ_CHUNK = 16
+# estimated ZCL header and per attribute record sizes of a
+# Read Attributes Response, used to fit it into the device buffer
+ZCL_HEADER_SIZE = 5
+READ_ATTR_RECORD_SIZE = 8
+# delay between consecutive requests to mains powered and sleepy devices
+PACE_MAINS = 0.05
+PACE_SLEEPY = 0.4
+BASIC_CLUSTER_ID = 0x0000
+SW_BUILD_ATTR_ID = 0x4000
+MAX_ATTR_ID = 0xFFFF
+MAX_CMD_ID = 0xFF
+
+
+def _acl_name(acl):
+    try:
+        return foundation.AttributeAccessControl(acl).name
+    except ValueError:
+        return "undefined"
+
+
+_ACL_NAMES = {acl: _acl_name(acl) for acl in range(256)}
+_ACL_READ = foundation.AttributeAccessControl.READ
+_DATA_TYPES = foundation.DATA_TYPES
+_Status = foundation.Status
+# (received, generated) command result keys for server and client clusters
+_KEYS_SERVER = ("commands_received", "commands_generated")
+_KEYS_CLIENT = ("commands_generated", "commands_received")
+_H2 = tuple("0x{:02x}".format(i) for i in range(256))
+
 
 @retryable((DeliveryError, asyncio.TimeoutError), tries=3)
 async def read_attr(cluster, attrs):
     return await cluster.read_attributes(attrs, allow_cache=False)
 
 
-@retryable((DeliveryError, asyncio.TimeoutError), tries=3)
-def wrapper(cmd, *args, **kwargs):
-    return cmd(*args, **kwargs)
-
-
-async def scan_results(device):
+@retryable((DeliveryError, asyncio.TimeoutError), tries=5, delay=0.5)
+async def wrapper(cmd, *args, **kwargs):
+    return await cmd(*args, **kwargs)
+
+
+def read_chunk_size(cluster):
+    """Number of attributes to request in a single Read Attributes command."""
+    device = cluster.endpoint.device
+    chunk_size = getattr(device, "_max_attrs_per_read", None)
+    if chunk_size:
+        return chunk_size
+
+    node_desc = getattr(device, "node_desc", None)
+    buffer_size = getattr(node_desc, "maximum_buffer_size", None)
+    if not buffer_size:
+        return MAX_READ_CHUNK
+    chunk_size = (buffer_size - ZCL_HEADER_SIZE) // READ_ATTR_RECORD_SIZE
+    return max(MIN_READ_CHUNK, min(MAX_READ_CHUNK, chunk_size))
+
+
+def request_pace(device):
+    """Delay between requests, depending on the device power source."""
+    node_desc = getattr(device, "node_desc", None)
+    if node_desc is not None and node_desc.is_mains_powered:
+        return PACE_MAINS
+    return PACE_SLEEPY
+
+
+async def _limited(semaphore, coro):
+    async with semaphore:
+        return await coro
+
+
+async def _sw_build(device):
+    """Read the device sw_build_id from the Basic cluster, None if unavailable."""
+    basic = next(
+        (
+            ep.in_clusters[BASIC_CLUSTER_ID]
+            for epid, ep in device.endpoints.items()
+            if epid != 0 and BASIC_CLUSTER_ID in ep.in_clusters
+        ),
+        None,
+    )
+    if basic is None:
+        return None
+    try:
+        success, _ = await basic.read_attributes([SW_BUILD_ATTR_ID], allow_cache=True)
+    except (DeliveryError, asyncio.TimeoutError) as ex:
+        LOGGER.debug("Couldn't read sw_build_id: %s", ex)
+        return None
+    return success.get(SW_BUILD_ATTR_ID)
+
+
+async def scan_results(device, schema_cache=None):
     result = {"ieee": str(device.ieee), "nwk": "0x{:04x}".format(device.nwk)}
 
     LOGGER.debug("Scanning device 0x{:04x}".format(device.nwk))
 
-    endpoints = []
-    for epid, ep in device.endpoints.items():
-        if epid == 0:
-            continue
-        LOGGER.debug("scanning endpoint #%i", epid)
-        result["model"] = ep.model
-        result["manufacturer"] = ep.manufacturer
-        endpoint = {
+    endpoints = [
+        {
             "id": epid,
             "device_type": "0x{:04x}".format(ep.device_type),
             "profile": "0x{:04x}".format(ep.profile_id),
         }
+        for epid, ep in device.endpoints.items()
+        if epid != 0
+    ]
+    first_ep = next((ep for epid, ep in device.endpoints.items() if epid), None)
+    if first_ep is not None:
+        result["model"] = first_ep.model
+        result["manufacturer"] = first_ep.manufacturer
+
+    # limit in-flight discovery requests to the device
+    semaphore = asyncio.Semaphore(2)
+    pace = request_pace(device)
+    sw_build = None
+    if schema_cache is not None:
+        sw_build = await _sw_build(device)
+        if sw_build is None:
+            LOGGER.debug("no sw_build_id, not using cluster schema cache")
+            schema_cache = None
+
+    async def _scan(endpoint):
+        epid = endpoint["id"]
+        LOGGER.debug("scanning endpoint #%i", epid)
         if epid != 242:
-            endpoint.update(await scan_endpoint(ep))
-        endpoints.append(endpoint)
+            endpoint.update(
+                await scan_endpoint(
+                    device.endpoints[epid],
+                    semaphore=semaphore,
+                    pace=pace,
+                    schema_cache=schema_cache,
+                    sw_build=sw_build,
+                )
+            )
+
+    await asyncio.gather(*(_scan(endpoint) for endpoint in endpoints))
 
     result["endpoints"] = endpoints
     return result
 
 
-async def scan_endpoint(ep):
+async def scan_endpoint(ep, **kwargs):
     result = {}
-    clusters = {}
-    for cluster in ep.in_clusters.values():
+    for key, clusters, is_server in (
+        ("in_clusters", ep.in_clusters, True),
+        ("out_clusters", ep.out_clusters, False),
+    ):
         LOGGER.debug(
-            "Scanning cluster_id 0x{:04x}/'{}' input cluster".format(
-                cluster.cluster_id, cluster.ep_attribute
+            "Scanning %s: %s",
+            key,
+            ["0x{:04x}".format(cluster_id) for cluster_id in clusters],
+        )
+        scans = await asyncio.gather(
+            *(
+                scan_cluster(cluster, is_server=is_server, **kwargs)
+                for cluster in clusters.values()
             )
         )
-        key = "0x{:04x}".format(cluster.cluster_id)
-        clusters[key] = await scan_cluster(cluster, is_server=True)
-    result["in_clusters"] = dict(sorted(clusters.items(), key=lambda k: k[0]))
-
-    clusters = {}
-    for cluster in ep.out_clusters.values():
-        LOGGER.debug(
-            "Scanning cluster_id 0x{:04x}/'{}' output cluster".format(
-                cluster.cluster_id, cluster.ep_attribute
+        result[key] = dict(
+            sorted(
+                ("0x{:04x}".format(cluster.cluster_id), scan)
+                for cluster, scan in zip(clusters.values(), scans)
             )
         )
-        key = "0x{:04x}".format(cluster.cluster_id)
-        clusters[key] = await scan_cluster(cluster, is_server=True)
-    result["out_clusters"] = dict(sorted(clusters.items(), key=lambda k: k[0]))
     return result
 
 
-async def scan_cluster(cluster, is_server=True):
-    if is_server:
-        cmds_gen = "commands_generated"
-        cmds_rec = "commands_received"
+async def scan_cluster(
+    cluster,
+    is_server=True,
+    semaphore=None,
+    pace=PACE_SLEEPY,
+    schema_cache=None,
+    sw_build=None,
+):
+    """Scan a cluster, reusing a schema cached from another device."""
+    cmds_rec, cmds_gen = _KEYS_SERVER if is_server else _KEYS_CLIENT
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(2)
+
+    ep = cluster.endpoint
+    ieee = ep.device.ieee
+    cache_key = None
+    schema = None
+    if schema_cache is not None and ep.manufacturer and ep.model:
+        cache_key = (
+            ep.manufacturer,
+            ep.model,
+            sw_build,
+            ep.endpoint_id,
+            cluster.cluster_id,
+            is_server,
+        )
+        entry = schema_cache.get(cache_key)
+        # a rescan of the same device always rediscovers its schema
+        if entry is not None and entry["ieee"] != ieee:
+            schema = entry["schema"]
+    if schema is None:
+        schema = await _scan_cluster_schema(cluster, semaphore, pace)
+        complete = schema.pop("complete")
+        if cache_key is not None and complete:
+            schema_cache[cache_key] = {"ieee": ieee, "schema": schema}
     else:
-        cmds_rec = "commands_generated"
-        cmds_gen = "commands_received"
+        LOGGER.debug(
+            "Using cached schema for cluster 0x{:04x}".format(cluster.cluster_id)
+        )
+
+    values = await _limited(
+        semaphore, _read_cluster_values(cluster, schema["to_read"], pace)
+    )
+    attributes = {}
+    for attr_id, attr in sorted(schema["attributes"].items()):
+        if attr_id in values:
+            attr = {**attr, "attribute_value": values[attr_id]}
+        attributes[attr["attribute_id"]] = attr
+
     return {
         "cluster_id": "0x{:04x}".format(cluster.cluster_id),
         "name": cluster.ep_attribute,
-        "attributes": await discover_attributes_extended(cluster),
-        cmds_rec: await discover_commands_received(cluster, is_server),
-        cmds_gen: await discover_commands_generated(cluster, is_server),
+        "attributes": attributes,
+        cmds_rec: schema["commands_received"],
+        cmds_gen: schema["commands_generated"],
     }
 
 
-async def discover_attributes_extended(cluster, manufacturer=None):
-    from zigpy.zcl import foundation
+async def _scan_cluster_schema(cluster, semaphore, pace):
+    """Discover cluster attributes and commands, without attribute values."""
+    LOGGER.debug("Discovering schema of cluster 0x{:04x}".format(cluster.cluster_id))
+    (attrs, to_read, attrs_done), (rec, rec_done), (gen, gen_done) = (
+        await asyncio.gather(
+            _limited(semaphore, _discover_attributes(cluster, pace=pace)),
+            _limited(
+                semaphore,
+                _discover_commands(
+                    cluster,
+                    cluster.discover_commands_received,
+                    cluster.server_commands,
+                    pace=pace,
+                ),
+            ),
+            _limited(
+                semaphore,
+                _discover_commands(
+                    cluster,
+                    cluster.discover_commands_generated,
+                    cluster.client_commands,
+                    pace=pace,
+                ),
+            ),
+        )
+    )
+    return {
+        "attributes": attrs,
+        "to_read": to_read,
+        "commands_received": rec,
+        "commands_generated": gen,
+        "complete": attrs_done and rec_done and gen_done,
+    }
+
 
-    LOGGER.debug("Discovering attributes extended")
+async def _discover_attributes(cluster, manufacturer=None, pace=PACE_SLEEPY):
+    """Return discovered attributes, readable attribute ids and completion."""
     result = {}
+    to_read = []
     attr_id = 0
     done = False
+    complete = False
 
     while not done:
         try:
@@ -103,7 +293,6 @@ async def discover_attributes_extended(cluster, manufacturer=None):
                 16,
                 manufacturer=manufacturer,
             )
-            await asyncio.sleep(0.4)
         except (DeliveryError, asyncio.TimeoutError) as ex:
             LOGGER.error(
                 "Failed to discover attributes extended starting %s. Error: {}".format(
@@ -111,148 +300,174 @@ async def discover_attributes_extended(cluster, manufacturer=None):
                 )
             )
             break
-        if isinstance(rsp, foundation.Status):
+        if isinstance(rsp, _Status):
             LOGGER.error(
                 "got %s status for discover_attribute starting %s", rsp, attr_id
             )
+            # a status response is the device's final answer, not a failure
+            complete = True
             break
+        if not rsp:
+            if not done:
+                LOGGER.debug("empty discover_attribute response starting %s", attr_id)
+                break
+            continue
         for attr_rec in rsp:
-            attr_id = attr_rec.attrid
-            attr_name = cluster.attributes.get(
-                attr_rec.attrid, (str(attr_rec.attrid), None)
-            )[0]
-            attr_type = foundation.DATA_TYPES.get(attr_rec.datatype)
+            rec_id = attr_rec.attrid
+            attr_name = cluster.attributes.get(rec_id, (str(rec_id), None))[0]
+            attr_type = _DATA_TYPES.get(attr_rec.datatype)
             if attr_type:
                 attr_type = [attr_type[1].__name__, attr_type[2].__name__]
             else:
-                attr_type = "0x{:02x}".format(attr_rec.datatype)
-            try:
-                access = foundation.AttributeAccessControl(attr_rec.acl).name
-            except ValueError:
-                access = "undefined"
-
-            result[attr_id] = {
-                "attribute_id": "0x{:04x}".format(attr_id),
+                attr_type = _H2[attr_rec.datatype]
+            access = _ACL_NAMES.get(attr_rec.acl, "undefined")
+            if attr_rec.acl & _ACL_READ and rec_id not in result:
+                to_read.append(rec_id)
+
+            result[rec_id] = {
+                "attribute_id": "0x{:04x}".format(rec_id),
                 "attribute_name": attr_name,
                 "value_type": attr_type,
                 "access": access,
             }
-            attr_id += 1
-        await asyncio.sleep(0.2)
+        next_id = max(attr_rec.attrid for attr_rec in rsp) + 1
+        if next_id <= attr_id:
+            LOGGER.debug("no progress in discover_attribute starting %s", attr_id)
+            break
+        # no attribute ids left past the end of the uint16 range
+        done = done or next_id > MAX_ATTR_ID
+        attr_id = next_id
+        await asyncio.sleep(pace)
+    else:
+        complete = True
+
+    return result, to_read, complete
+
 
-    to_read = list(result.keys())
+async def _read_cluster_values(cluster, to_read, pace=PACE_SLEEPY):
+    """Read attribute values, return them keyed by attribute id."""
     LOGGER.debug("Reading attrs: %s", to_read)
-    chunk, to_read = to_read[:4], to_read[4:]
-    while chunk:
+    result = {}
+    chunk_size = read_chunk_size(cluster)
+    while to_read:
+        chunk = to_read[:chunk_size]
         try:
             success, failed = await read_attr(cluster, chunk)
+        except (DeliveryError, asyncio.TimeoutError) as ex:
+            if chunk_size > MIN_READ_CHUNK:
+                chunk_size = max(MIN_READ_CHUNK, chunk_size // 2)
+                LOGGER.debug(
+                    "Failed reading %s attrs, retrying with %s: %s",
+                    len(chunk),
+                    chunk_size,
+                    ex,
+                )
+                continue
+            LOGGER.error("Couldn't read attr_ids %s: %s", chunk, ex)
+        else:
             LOGGER.debug("Reading attr success: %s, failed %s", success, failed)
             for attr_id, value in success.items():
                 if isinstance(value, bytes):
+                    head = value.partition(b"\x00")[0]
                     try:
-                        value = value.split(b"\x00")[0].decode().strip()
+                        value = head.decode("utf-8").strip()
                     except UnicodeDecodeError:
                         value = value.hex()
-                result[attr_id]["attribute_value"] = value
-        except (DeliveryError, asyncio.TimeoutError) as ex:
-            LOGGER.error("Couldn't read attr_id %i: %s", attr_id, ex)
-        chunk, to_read = to_read[:4], to_read[4:]
-        await asyncio.sleep(0.3)
-
-    return {
-        "0x{:04x}".format(a_id): result[a_id] for a_id in sorted(result)
-    }
+                result[attr_id] = value
+        to_read = to_read[len(chunk) :]
+        await asyncio.sleep(pace)
 
+    return result
 
-async def discover_commands_received(cluster, is_server, manufacturer=None):
-    from zigpy.zcl.foundation import Status
 
-    LOGGER.debug("Discovering commands received")
-    direction = "received" if is_server else "generated"
+async def _discover_commands(
+    cluster, discover_fn, cmd_table, manufacturer=None, pace=PACE_SLEEPY
+):
+    """Return discovered commands and whether the discovery completed."""
     result = {}
     cmd_id = 0
     done = False
+    complete = False
 
     while not done:
         try:
             done, rsp = await wrapper(
-                cluster.discover_commands_received,
+                discover_fn,
                 cmd_id,
                 16,
                 manufacturer=manufacturer,
             )
-            await asyncio.sleep(0.3)
         except (DeliveryError, asyncio.TimeoutError) as ex:
             LOGGER.error(
                 "Failed to discover commands starting %s. Error: {}".format(cmd_id, ex)
             )
             break
-        if isinstance(rsp, Status):
+        if isinstance(rsp, _Status):
             LOGGER.error(
                 "got %s status for discover_attribute starting %s", rsp, cmd_id
             )
+            # a status response is the device's final answer, not a failure
+            complete = True
             break
-        for cmd_id in rsp:
-            cmd_data = cluster.server_commands.get(
-                cmd_id, (str(cmd_id), "not_in_zcl", None)
-            )
+        if not rsp:
+            if not done:
+                LOGGER.debug("empty discover_commands response starting %s", cmd_id)
+                break
+            continue
+        for rec_id in rsp:
+            cmd_data = cmd_table.get(rec_id, (str(rec_id), "not_in_zcl", None))
             cmd_name, cmd_args, _ = cmd_data
             if not isinstance(cmd_args, str):
                 cmd_args = [arg.__name__ for arg in cmd_args]
-            key = "0x{:02x}".format(cmd_id)
+            key = _H2[rec_id]
             result[key] = {
-                "command_id": "0x{:02x}".format(cmd_id),
+                "command_id": key,
                 "command_name": cmd_name,
                 "command_arguments": cmd_args,
             }
-            cmd_id += 1
-        await asyncio.sleep(0.2)
-    return dict(sorted(result.items(), key=lambda k: k[0]))
+        next_id = max(rsp) + 1
+        if next_id <= cmd_id:
+            LOGGER.debug("no progress in discover_commands starting %s", cmd_id)
+            break
+        # no command ids left past the end of the uint8 range
+        done = done or next_id > MAX_CMD_ID
+        cmd_id = next_id
+        await asyncio.sleep(pace)
+    else:
+        complete = True
 
+    return dict(sorted(result.items())), complete
 
-async def discover_commands_generated(cluster, is_server, manufacturer=None):
-    from zigpy.zcl.foundation import Status
 
-    direction = "generated" if is_server else "received"
-    result = {}
-    cmd_id = 0
-    done = False
+def _save_scan(file_name, scan):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    _atomic_write_bytes(file_name, _dump_scan(scan))
 
-    while not done:
+
+def _dump_scan(scan):
+    """Serialize scan results, with the same layout with or without orjson."""
+    if orjson is not None:
         try:
-            done, rsp = await wrapper(
-                cluster.discover_commands_generated,
-                cmd_id,
-                16,
-                manufacturer=manufacturer,
-            )
-            await asyncio.sleep(0.3)
-        except (DeliveryError, asyncio.TimeoutError) as ex:
-            LOGGER.error(
-                "Failed to discover commands starting %s. Error: {}".format(cmd_id, ex)
-            )
-            break
-        if isinstance(rsp, Status):
-            LOGGER.error(
-                "got %s status for discover_attribute starting %s", rsp, cmd_id
-            )
-            break
-        for cmd_id in rsp:
-            cmd_data = cluster.client_commands.get(
-                cmd_id, (str(cmd_id), "not_in_zcl", None)
-            )
-            cmd_name, cmd_args, _ = cmd_data
-            if not isinstance(cmd_args, str):
-                cmd_args = [arg.__name__ for arg in cmd_args]
-            key = "0x{:02x}".format(cmd_id)
-            result[key] = {
-                "command_id": "0x{:02x}".format(cmd_id),
-                "command_Name": cmd_name,
-                "command_args": cmd_args,
-            }
-            cmd_id += 1
-        await asyncio.sleep(0.2)
-    return dict(sorted(result.items(), key=lambda k: k[0]))
+            return orjson.dumps(scan, option=orjson.OPT_INDENT_2)
+        except TypeError as ex:
+            LOGGER.debug("orjson couldn't serialize scan results: %s", ex)
+    data = json.dumps(scan, indent=2, ensure_ascii=False, cls=JSONEncoder)
+    return data.encode("utf-8")
+
+
+def _atomic_write_bytes(file_name, data):
+    fd, tmp_name = tempfile.mkstemp(
+        dir=os.path.dirname(file_name), prefix=".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as tmp_file:
+            os.fchmod(tmp_file.fileno(), 0o644)
+            tmp_file.write(data)
+        os.replace(tmp_name, file_name)
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.remove(tmp_name)
+        raise
 
 
 async def scan_device(app, listener, ieee, cmd, data, service):
@@ -262,21 +477,21 @@ async def scan_device(app, listener, ieee, cmd, data, service):
 
     LOGGER.debug("running 'scan_device' command: %s", service)
     device = app.get_device(ieee=ieee)
-    scan = await scan_results(device)
+    zhac_data = listener._hass.data.setdefault(DATA_ZHAC, {})
+    schema_cache = zhac_data.setdefault("scan_schemas", {})
+    scan = await scan_results(device, schema_cache=schema_cache)
 
     model = scan.get("model")
     manufacturer = scan.get("manufacturer")
     if model is not None and manufacturer is not None:
-        ieee_tail = "".join(["%02x" % (o,) for o in ieee[-4:]])
+        ieee_tail = bytes(ieee[-4:]).hex()
         file_name = "{}_{}_{}_scan_results.txt".format(model, manufacturer, ieee_tail)
     else:
-        ieee_tail = "".join(["%02x" % (o,) for o in ieee])
-        file_name = "{}_scan_results.txt".format(ieee_tail)
+        ieee_full = bytes(ieee).hex()
+        file_name = "{}_scan_results.txt".format(ieee_full)
 
     conf_dir = listener._hass.config.config_dir
     scan_dir = os.path.join(conf_dir, "scans")
-    if not os.path.isdir(scan_dir):
-        os.mkdir(scan_dir)
     file_name = os.path.join(scan_dir, file_name)
-    save_json(file_name, scan)
-    LOGGER.debug("Finished writing scan results int '%s'", file_name)
\ No newline at end of file
+    await listener._hass.async_add_executor_job(_save_scan, file_name, scan)
+    LOGGER.debug("Finished writing scan results int '%s'", file_name)